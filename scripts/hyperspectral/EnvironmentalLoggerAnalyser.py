@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 
 '''
 EnvironmentalLoggerAnalyser.py
@@ -7,29 +7,31 @@ EnvironmentalLoggerAnalyser.py
 This module will read data generated by Environmental Sensor and convert to netCDF file
 ----------------------------------------------------------------------------------------
 Prerequisite:
-1. Python (2.7+ recommended)
+1. Python 3
 2. netCDF4 module for Python (and many other supplements such as numpy, scipy and HDF5 if needed)
+3. orjson or pysimdjson module for Python (optional, the standard json module is used without them)
 ----------------------------------------------------------------------------------------
 
 Usage:
-python EnvironmentalLoggerAnalyser.py drc_in drc_out
-python EnvironmentalLoggerAnalyser.py fl_in drc_out
+python3 EnvironmentalLoggerAnalyser.py drc_in drc_out
+python3 EnvironmentalLoggerAnalyser.py fl_in drc_out
 where drc_in is input directory, drc_out is output directory, fl_in is input file
 Input  filenames must have '.json' extension
 Output filenames will have '.nc' extension
 
 UCI test:
-python ${HOME}/terraref/computing-pipeline/scripts/hyperspectral/EnvironmentalLoggerAnalyser.py ${DATA}/terraref/input ${DATA}/terraref/output
+python3 ${HOME}/terraref/computing-pipeline/scripts/hyperspectral/EnvironmentalLoggerAnalyser.py ${DATA}/terraref/input ${DATA}/terraref/output
 
 UCI production:
-python ${HOME}/terraref/computing-pipeline/scripts/hyperspectral/EnvironmentalLoggerAnalyser.py ${DATA}/terraref/EnvironmentLogger/2016-04-07/2016-04-07_12-00-07_enviromentlogger.json ~/rgr
+python3 ${HOME}/terraref/computing-pipeline/scripts/hyperspectral/EnvironmentalLoggerAnalyser.py ${DATA}/terraref/EnvironmentLogger/2016-04-07/2016-04-07_12-00-07_enviromentlogger.json ~/rgr
 
 Roger production:
-module add gdal-stack-2.7.10 
-python ${HOME}/terraref/computing-pipeline/scripts/hyperspectral/EnvironmentalLoggerAnalyser.py /projects/arpae/terraref/raw_data/ua-mac/EnvironmentLogger/2016-04-07/2016-04-07_12-00-07_enviromentlogger.json ~/rgr
+(load a Python 3 environment with numpy and netCDF4 first)
+python3 ${HOME}/terraref/computing-pipeline/scripts/hyperspectral/EnvironmentalLoggerAnalyser.py /projects/arpae/terraref/raw_data/ua-mac/EnvironmentLogger/2016-04-07/2016-04-07_12-00-07_enviromentlogger.json ~/rgr
 
 EnvironmentalLoggerAnalyser.py will take the second parameter as the input folder (containing JSON files,
-but it can also be one single file) and the third parameter as the output folder (will dump netCDF files here).
+but it can also be one single file) and the third parameter as the output folder (will dump netCDF files here, keeping the subfolders
+of the input folder).
 If the output folder does not exist, EnvironmentalLoggerAnalyser.py will create it.
 
 ----------------------------------------------------------------------------------------
@@ -43,204 +45,238 @@ Update 5.3
 Add chuncksizes parameters for time, which significantly reduces the processing time (and the file size)
 Add timestamps and commandLine the user used for each exported file
 Remind the user currently the script is dealing with which file
-
-TODO List:
-
-1. reassign the variable "time" as the offset to the base time (temporary it is the UNIX base time)
 ----------------------------------------------------------------------------------------
 Thanks for the advice from Professor Zender and testing data from Mr. Maloney
 ----------------------------------------------------------------------------------------
 '''
 
-import json
+import mmap
+import re
 import time
+import calendar
 import sys
 import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 from netCDF4 import Dataset
+try:
+    from orjson import loads as _loads  # Fastest at building full objects, and parses the mapped file in place
+    _PARSES_BUFFERS = True
+except ImportError:
+    _PARSES_BUFFERS = False
+    try:
+        from simdjson import Parser
+        _PARSER = Parser()
+
+        def _loads(buffer):
+            return _PARSER.parse(buffer, True)  # Fully converted, so the parser is free for the next record
+    except ImportError:
+        from json import loads as _loads
 
 _UNIT_DICTIONARY = {u'm': 'meter', u"hPa": "hecto-Pascal", u"DegCelsius": "Celsius",
                     u's': 'second', u'm/s': 'meter second-1', u"mm/h": 'milimeters hour-1',
                     u"relHumPerCent": "percent", u"?mol/(m^2*s)": "micromole meters-2 second-1",
                     u'kilo Lux': 'kilo Lux', u'degrees': 'degrees', '': ''}
 _NAMES = {'sensor par': 'Sensor Photosynthetical Active Radiation'}
-
-
-def formattingTheJSONFileAndReturnWavelengthAndSpectrum(fileLocation):
-    '''
-    This function will format the source JSON file including multiple JSON objects
-    into a file of JSON array
-    '''
-    with open(fileLocation, 'r+') as fileHandler:
-        tempList, linePosition, wavelengthList, spectrumList, j, k =\
-            fileHandler.read().split('\n'), list(), [[]], [[]], 0, 0
-        for i in range(len(tempList)):
-            if "environment_sensor_set_reading" in tempList[i] and i > 2:
-                linePosition.append(i - 1)
-            if "wavelength" in tempList[i]:
-                wavelengthList[j].append(
-                    float(tempList[i][tempList[i].find(':') + 1: -2]))
-            if "wavelength" not in tempList[i] and "wavelength" in tempList[i - 4]\
-                    and "band" not in tempList[i] and "," not in tempList[i]:
-                wavelengthList.append([])
-                j += 1
-                spectrumList.append([])
-                k += 1
-            if "spectrum" in tempList[i]:
-                spectrumList[k].append(
-                    float(tempList[i][tempList[i].find(':') + 1: -2]))
-
-        wavelengthList.remove([])
-        spectrumList.remove([])
-
-        for line in linePosition:
-            del tempList[line]
-            tempList.insert(line, "},{")
-
-        fileHandler.seek(0)
-        fileHandler.truncate()
-
-        if '[' not in tempList[0] and ']' not in tempList[-1]:
-            tempList.insert(0, '[')
-            tempList.append(']')
-            fileHandler.write('\n'.join(tempList))
-        else:
-            fileHandler.write('\n'.join(tempList))
-    return wavelengthList, spectrumList
+# Every JSON object in the source file opens with this member
+_RECORD_START = re.compile(br'\{\s*"environment_sensor_set_reading"')
+# Shuffled deflate suits the slowly varying float readings; chunks hold ~4KB of a series
+# and a block of complete spectra respectively
+_COMPRESSION = {'zlib': True, 'complevel': 4, 'shuffle': True}
+_TIME_CHUNK, _SPECTRUM_CHUNK = 1024, 64
+# Timestamps are recorded like 2016.04.07-12:00:07 and are stored as seconds since the UNIX epoch;
+# the logger writes them without a time zone, so they are read as UTC (see the comment on "time")
+_TIMESTAMP_FORMAT = "%Y.%m.%d-%H:%M:%S"
 
 
 def JSONHandler(fileLocation):
     '''
-    Main JSON handler, write JSON file to a Python list with standard JSON module
+    Main JSON handler, parse the JSON objects concatenated in the source file in a single pass
+    and collect the wavelength and spectrum from the spectrometer along the way
     '''
-    wavelength, spectrum = formattingTheJSONFileAndReturnWavelengthAndSpectrum(
-        fileLocation)
-    with open(fileLocation, 'r') as fileHandler:
-        return json.loads(fileHandler.read()), wavelength, spectrum
+    JSONArray, wavelength, spectrum = list(), None, None
+    with open(fileLocation, 'rb') as fileHandler:
+        with mmap.mmap(fileHandler.fileno(), 0, access=mmap.ACCESS_READ) as fileBuffer:
+            recordStarts = [match.start() for match in _RECORD_START.finditer(fileBuffer)]
+            recordStarts.append(len(fileBuffer))
+
+            # orjson parses slices of a memoryview without copying them out of the map; the other
+            # parsers take plain bytes slices, which also keep a failed parse from holding the map open
+            fileView = memoryview(fileBuffer) if _PARSES_BUFFERS else fileBuffer
+            try:
+                for i, (start, end) in enumerate(zip(recordStarts[:-1], recordStarts[1:])):
+                    # Ends at the closing brace, leaving out separators or the "]" of a formatted array
+                    record = _loads(fileView[start:fileBuffer.rfind(b'}', start, end) + 1])
+                    JSONArray.append(record)
+                    spectrometer = record["environment_sensor_set_reading"].get("spectrometer")
+                    if spectrometer and "band" in spectrometer:
+                        bands = spectrometer["band"]
+                        if wavelength is None:  # Every reading shares the wavelengths of the first one
+                            wavelength = np.fromiter((band["wavelength"] for band in bands),
+                                                     dtype=np.float32, count=len(bands))
+                            # One row per record so the rows line up with "time"; records without
+                            # a reading keep NaN
+                            spectrum = np.full((len(recordStarts) - 1, len(bands)), np.nan, dtype=np.float32)
+                        spectrum[i] = [band["spectrum"] for band in bands]
+            finally:
+                if _PARSES_BUFFERS:
+                    fileView.release()  # The map cannot be closed while the view is exported
+
+    return JSONArray, wavelength, spectrum
 
 
 def renameTheValue(name):
     '''
     Rename the value so it becomes legal in netCDF
     '''
-    if type(name) is unicode:
-        name = name.encode('ascii', 'ignore')
-    if name in _UNIT_DICTIONARY:
-        name = _UNIT_DICTIONARY[name]
-    elif name in _NAMES:
-        name = _NAMES[name]
-
-    returningString = str()
-    for letters in name:
-        if letters == ' ':
-            returningString += '_'
-        else:
-            returningString += letters
-    return returningString
+    return _UNIT_DICTIONARY.get(name, _NAMES.get(name, name)).replace(' ', '_')
 
 
 def getSpectrometerInformation(arrayOfJSON):
     '''
     Collect information from spectrometer with special care
     '''
-    maxFixedIntensity = [int(intensityMembers["spectrometer"]["maxFixedIntensity"]) for intensityMembers in
-                         arrayOfJSON]
-    integrationTime = [int(integrateMembers["spectrometer"]["integration time in ?s"]) for integrateMembers in
-                       arrayOfJSON]
+    maxFixedIntensity, integrationTime =\
+        np.empty(len(arrayOfJSON), dtype=np.int32), np.empty(len(arrayOfJSON), dtype=np.int32)
+    for i, members in enumerate(arrayOfJSON):  # Both members come out of a single walk
+        spectrometer = members["spectrometer"]
+        maxFixedIntensity[i] = int(spectrometer["maxFixedIntensity"])
+        integrationTime[i] = int(spectrometer["integration time in ?s"])
 
     return maxFixedIntensity, integrationTime
 
 
-def getListOfValue(arrayOfJSON, dataName):
+def getArraysOfValue(arrayOfJSON):
     '''
-    Collect data from JSON objects which have "value" member
+    Collect the "value" (and "rawValue" if any) members of every sensor in a single pass
+    over the JSON objects; return a dictionary of (value, rawValue) arrays keyed by the sensor
     '''
-    return [float(valueMembers[dataName]['value'].encode('ascii', 'ignore')) for valueMembers in arrayOfJSON]
+    schema = [(data, np.empty(len(arrayOfJSON), dtype=np.float32),
+               np.empty(len(arrayOfJSON), dtype=np.float32) if 'rawValue' in sample else None)
+              for data, sample in arrayOfJSON[0].items()
+              if data != 'spectrometer' and not isinstance(sample, str)]
+
+    for i, members in enumerate(arrayOfJSON):
+        for data, valueArray, rawValueArray in schema:
+            valueArray[i] = float(members[data]['value'])
+            if rawValueArray is not None:
+                rawValueArray[i] = float(members[data]['rawValue'])
+
+    return dict((data, (valueArray, rawValueArray)) for data, valueArray, rawValueArray in schema)
 
 
-def getListOfRawValue(arrayOfJSON, dataName):
+def getTimeStamps(arrayOfJSON, fileName):
     '''
-    Collect data from JSON objects which have "rawValue" member
+    Convert the timestamps to seconds since the UNIX epoch; "time" is a coordinate and cannot hold
+    missing values, so a timestamp in any other format fails the file it comes from
     '''
-    return [float(valueMembers[dataName]['rawValue'].encode('ascii', 'ignore')) for valueMembers in arrayOfJSON]
+    timeStamps = np.empty(len(arrayOfJSON), dtype=np.float64)
+    for i, members in enumerate(arrayOfJSON):
+        try:
+            timeStamps[i] = calendar.timegm(time.strptime(members['timestamp'], _TIMESTAMP_FORMAT))
+        except ValueError:
+            raise ValueError('%s: record %d has timestamp %r, expected the format %s' %
+                             (fileName, i, members['timestamp'], _TIMESTAMP_FORMAT))
+
+    return timeStamps
 
 
 def _timeStamp():
     return time.strftime("%a %b %d %H:%M:%S %Y",  time.localtime(int(time.time())))
 
 
-def main(JSONArray, outputFileName, wavelength=None, spectrum=None, recordTime=None, commandLine=None):
+def main(JSONArray, outputFileName, wavelength=None, spectrum=None, recordTime=None, commandLine=None,
+         sourceFileName=None):
     '''
     Main netCDF handler, write data to the netCDF file indicated.
     '''
-    netCDFHandler = Dataset(outputFileName, 'w', format='NETCDF4')
     dataMemberList = [JSONMembers[u"environment_sensor_set_reading"]
                       for JSONMembers in JSONArray]
-    timeStampList = [JSONMembers[u'timestamp']
-                     for JSONMembers in dataMemberList]
+    # Checked before the netCDF file is created, so a bad file leaves no partial output behind
+    timeStampList = getTimeStamps(dataMemberList, sourceFileName)
+    netCDFHandler = Dataset(outputFileName, 'w', format='NETCDF4')
     timeDimension = netCDFHandler.createDimension("time", None)
+    timeChunk = (min(_TIME_CHUNK, max(1, len(timeStampList))),)  # Not wider than the series itself
     tempTimeVariable = netCDFHandler.createVariable(
-        'time', str, ('time',), chunksizes=(1,))
-    for i in range(len(timeStampList)):  # Assign Times
-        tempTimeVariable[i] = timeStampList[i]
-
-    for data in dataMemberList[0]:
-        if data != 'spectrometer' and type(dataMemberList[0][data]) not in (str, unicode):
+        'time', 'f8', ('time',), chunksizes=timeChunk, **_COMPRESSION)
+    tempTimeVariable.units = 'seconds since 1970-01-01 00:00:00'
+    tempTimeVariable.comment = 'The logger records timestamps without a time zone; they are taken as UTC'
+    tempTimeVariable[:] = timeStampList  # Assign Times
+
+    arraysOfValue = getArraysOfValue(dataMemberList)
+    for data, sample in dataMemberList[0].items():
+        if data in arraysOfValue:
+            valueArray, rawValueArray = arraysOfValue[data]
             tempVariable = netCDFHandler.createVariable(
-                renameTheValue(data), 'f4', ('time',))
-            tempVariable[:] = getListOfValue(
-                dataMemberList, data)  # Assign "values"
-            if 'unit' in dataMemberList[0][data]:  # Assign Units
-                setattr(tempVariable, 'units', _UNIT_DICTIONARY[
-                        dataMemberList[0][data]['unit']])
-            if 'rawValue' in dataMemberList[0][data]:  # Assign "rawValues"
-                netCDFHandler.createVariable(renameTheValue(data) + '_rawValue', 'f4', ('time',))[:] =\
-                    getListOfRawValue(dataMemberList, data)
-        elif type(dataMemberList[0][data]) in (str, unicode):
-            netCDFHandler.createVariable(renameTheValue(data), str)[
-                0] = dataMemberList[0][data]
+                renameTheValue(data), 'f4', ('time',), chunksizes=timeChunk, **_COMPRESSION)
+            tempVariable[:] = valueArray  # Assign "values"
+            if 'unit' in sample:  # Assign Units
+                setattr(tempVariable, 'units', _UNIT_DICTIONARY[sample['unit']])
+            if rawValueArray is not None:  # Assign "rawValues"
+                netCDFHandler.createVariable(renameTheValue(data) + '_rawValue', 'f4', ('time',),
+                                             chunksizes=timeChunk, **_COMPRESSION)[:] =\
+                    rawValueArray
+        elif isinstance(sample, str):
+            netCDFHandler.createVariable(renameTheValue(data), str)[0] = sample
 
         if data == 'spectrometer':  # Special care for spectrometers :)
-            netCDFHandler.createVariable('Spectrometer_maxFixedIntensity', 'f4', ('time',))[:] =\
-                getSpectrometerInformation(dataMemberList)[0]
-            netCDFHandler.createVariable('Spectrometer_Integration_Time_In_Microseconds', 'f4', ('time',))[:] =\
-                getSpectrometerInformation(dataMemberList)[1]
-
-    if wavelength and spectrum:
-        netCDFHandler.createDimension("wavelength", len(wavelength[0]))
+            maxFixedIntensity, integrationTime = getSpectrometerInformation(dataMemberList)
+            netCDFHandler.createVariable('Spectrometer_maxFixedIntensity', 'f4', ('time',),
+                                         chunksizes=timeChunk, **_COMPRESSION)[:] =\
+                maxFixedIntensity
+            netCDFHandler.createVariable('Spectrometer_Integration_Time_In_Microseconds', 'f4', ('time',),
+                                         chunksizes=timeChunk, **_COMPRESSION)[:] =\
+                integrationTime
+
+    if wavelength is not None and spectrum is not None:
+        netCDFHandler.createDimension("wavelength", len(wavelength))
         netCDFHandler.createVariable("wavelength", 'f4', ('wavelength',))[
-            :] = wavelength[0]
-        netCDFHandler.createVariable("spectrum", 'f4', ('time', 'wavelength'))[
-            :, :] = spectrum
+            :] = wavelength
+        netCDFHandler.createVariable("spectrum", 'f4', ('time', 'wavelength'),
+                                     chunksizes=(min(_SPECTRUM_CHUNK, spectrum.shape[0]), spectrum.shape[1]),
+                                     **_COMPRESSION)[:, :] = spectrum
 
     netCDFHandler.history = recordTime + ': python ' + commandLine
     netCDFHandler.close()
 
 
+def _processTheFile(job):
+    '''
+    Convert a single JSON file to netCDF; this is the work handed to each worker process
+    '''
+    fileLocation, outputFileName, commandLine = job
+    print("Processing", os.path.split(fileLocation)[-1] + '....')
+    tempJSONMasterList, wavelength, spectrum = JSONHandler(fileLocation)
+    main(tempJSONMasterList, outputFileName, wavelength, spectrum, _timeStamp(), commandLine, fileLocation)
+
+
 if __name__ == '__main__':
     fileInputLocation, fileOutputLocation = sys.argv[1], sys.argv[2]
     if not os.path.exists(fileOutputLocation):
         os.mkdir(fileOutputLocation)  # Create folder
 
     if not os.path.isdir(fileInputLocation):
-        print "Processing", fileInputLocation + '....'
+        print("Processing", fileInputLocation + '....')
         tempJSONMasterList, wavelength, spectrum = JSONHandler(
             fileInputLocation)
         if not os.path.isdir(fileOutputLocation):
             main(tempJSONMasterList, fileOutputLocation, wavelength, spectrum,
-                 _timeStamp(), sys.argv[1] + ' ' + sys.argv[2])
+                 _timeStamp(), sys.argv[1] + ' ' + sys.argv[2], fileInputLocation)
         else:
             outputFileName = os.path.split(fileInputLocation)[-1]
             main(tempJSONMasterList, os.path.join(fileOutputLocation,
-                                                  outputFileName.strip('.json') + '.nc'), wavelength, spectrum,
-                 _timeStamp(), sys.argv[1] + ' ' + sys.argv[2])
+                                                  os.path.splitext(outputFileName)[0] + '.nc'), wavelength, spectrum,
+                 _timeStamp(), sys.argv[1] + ' ' + sys.argv[2], fileInputLocation)
     else:  # Read and Export netCDF to folder
-        for filePath, fileDirectory, fileName in os.walk(fileInputLocation):
-            for members in fileName:
-                if os.path.join(filePath, members).endswith('.json'):
-                    print "Processing", members + '....'
-                    outputFileName = members.strip('.json') + '.nc'
-                    tempJSONMasterList, wavelength, spectrum = JSONHandler(
-                        os.path.join(filePath, members))
-                    main(tempJSONMasterList, os.path.join(
-                        fileOutputLocation, outputFileName),
-                        wavelength, spectrum, _timeStamp(), sys.argv[1] + ' ' + sys.argv[2])
+        # Outputs mirror the input subfolders, so files sharing a name in different subfolders
+        # never have two workers writing the same netCDF file
+        jobs = [(os.path.join(filePath, members),
+                 os.path.normpath(os.path.join(fileOutputLocation, os.path.relpath(filePath, fileInputLocation),
+                                               os.path.splitext(members)[0] + '.nc')),
+                 sys.argv[1] + ' ' + sys.argv[2])
+                for filePath, fileDirectory, fileName in os.walk(fileInputLocation)
+                for members in fileName if members.endswith('.json')]
+        for outputFolder in set(os.path.dirname(job[1]) for job in jobs):
+            os.makedirs(outputFolder, exist_ok=True)
+        with ProcessPoolExecutor() as pool:  # Files are independent, so convert them on every core
+            list(pool.map(_processTheFile, jobs))  # Drain the results so a failed file is reported